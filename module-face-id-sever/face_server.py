@@ -3,20 +3,43 @@ Face Recognition Server for Unity Integration
 - Environment: Ubuntu 24.04 x86_64
 - Features: Image Enhancement, Smart Resize, No Flip
 - Storage: Saves processed images to './captured_images/'
+- Production: gunicorn -w 1 -k gthread --threads 16 -b 0.0.0.0:5000 face_server:app
+  (python face_server.py = Werkzeug 개발 서버, 전시 운영 시에는 gunicorn 권장.
+   --preload 금지: 마스터에서 모델/워커 스레드가 뜨고 fork된 워커에는 스레드가
+   없어 get_face_embedding이 영원히 대기함. CUDA 컨텍스트도 fork-safe하지 않음)
 """
 import os
 import sys
 import json
 import time
+import queue
 import base64
-import datetime
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import cv2
 from numpy.linalg import norm
 from insightface.app import FaceAnalysis
+from insightface.utils import face_align
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 
+try:
+    import faiss  # 설치 시 SIMD 최적화 검색 사용 (없어도 동작)
+except ImportError:
+    faiss = None
+
+try:
+    import pybase64 as _b64  # SSSE3/AVX2 가속 디코더 (없으면 표준 base64)
+except ImportError:
+    _b64 = base64
+
+try:
+    from numba import njit, prange  # FAISS/BLAS 없는 배포용 폴백 커널
+except ImportError:
+    njit = None
+
 # ====================
 # 환경 및 이미지 처리 설정
 # ====================
@@ -24,7 +47,8 @@ if sys.platform == "win32":
     cuda_bin = r"C:\Program Files\NVIDIA GPU Computing Toolkit\CUDA\v12.6\bin"
     if os.path.isdir(cuda_bin): os.add_dll_directory(cuda_bin)
 
-DB_PATH = "face_db.json"
+DB_PATH = "face_db.npz"
+LEGACY_DB_PATH = "face_db.json"  # 구버전 JSON DB (최초 1회 마이그레이션용)
 SAVE_DIR = "captured_images"  # 이미지 저장 루트 폴더
 
 IMG_CONFIG = {
@@ -46,85 +70,259 @@ app = Flask(__name__)
 CORS(app)
 
 print(" Initializing Face Server on Ubuntu...")
-face_app = FaceAnalysis(name='buffalo_l', providers=['CUDAExecutionProvider'])
+# TensorRT EP 우선 (fp16 + 엔진 캐시, 최초 1회 빌드) / 미설치 시 ORT가 CUDA로 폴백
+_ORT_PROVIDERS = [
+    ('TensorrtExecutionProvider', {
+        'trt_fp16_enable': True,
+        'trt_engine_cache_enable': True,
+        'trt_engine_cache_path': './trt_cache',
+    }),
+    'CUDAExecutionProvider',
+]
+face_app = FaceAnalysis(name='buffalo_l', providers=_ORT_PROVIDERS)
 face_app.prepare(ctx_id=0)
 print("✅ Model Loaded")
 
+# ====================
+# 인식 마이크로 배칭 (동시 요청의 얼굴 크롭을 모아 한 번에 추론)
+# ====================
+MAX_BATCH = 8
+BATCH_TIMEOUT = 0.01  # sec, 배치를 모으기 위해 기다리는 최대 시간
+
+rec_model = face_app.models['recognition']
+_EMBED_Q = queue.Queue()
+
+# IoBinding: GPU 출력 버퍼를 배치 크기별로 미리 잡아 재사용 -> 호출마다의 스테이징 할당 제거
+try:
+    import onnxruntime as ort
+    _REC_IO = rec_model.session.io_binding()
+    _REC_OUT_DIM = rec_model.session.get_outputs()[0].shape[-1]
+    # CPU 전용 빌드면 여기서 바로 실패시켜 get_feat 폴백으로 (요청 중 500 방지)
+    _REC_OUT_CACHE = {1: ort.OrtValue.ortvalue_from_shape_and_type((1, _REC_OUT_DIM), np.float32, 'cuda', 0)}
+except Exception:
+    _REC_IO = None
+
+def _rec_forward(crops):
+    """정렬된 얼굴 크롭 리스트 -> (B, D) 임베딩 배치 추론"""
+    if _REC_IO is None:
+        return np.asarray(rec_model.get_feat(crops)).reshape(len(crops), -1)
+    blob = cv2.dnn.blobFromImages(crops, 1.0 / rec_model.input_std, rec_model.input_size,
+                                  (rec_model.input_mean,) * 3, swapRB=True)
+    b = blob.shape[0]
+    out = _REC_OUT_CACHE.get(b)
+    if out is None:
+        out = ort.OrtValue.ortvalue_from_shape_and_type((b, _REC_OUT_DIM), np.float32, 'cuda', 0)
+        _REC_OUT_CACHE[b] = out
+    _REC_IO.bind_cpu_input(rec_model.input_name, blob)
+    _REC_IO.bind_ortvalue_output(rec_model.output_names[0], out)
+    rec_model.session.run_with_iobinding(_REC_IO)
+    return out.numpy()
+
+def _embed_worker():
+    while True:
+        items = [_EMBED_Q.get()]
+        deadline = time.time() + BATCH_TIMEOUT
+        while len(items) < MAX_BATCH:
+            remain = deadline - time.time()
+            if remain <= 0: break
+            try:
+                items.append(_EMBED_Q.get(timeout=remain))
+            except queue.Empty:
+                break
+        try:
+            feats = _rec_forward([crop for crop, _, _ in items])
+            for (_, holder, done), feat in zip(items, feats):
+                holder["embedding"] = feat
+                done.set()
+        except Exception as e:
+            for _, holder, done in items:
+                holder["error"] = e
+                done.set()
+
+threading.Thread(target=_embed_worker, daemon=True).start()
+
+# 전처리(cv2/base64는 GIL을 풀어줌)를 풀에서 돌려 GPU 추론과 겹치게 함
+_PREP_POOL = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+def get_face_embedding(img):
+    """가장 큰 얼굴을 검출하고 배치 워커로 임베딩 추출 (얼굴 없으면 None)"""
+    bboxes, kpss = face_app.det_model.detect(img, max_num=0, metric='default')
+    if bboxes.shape[0] == 0:
+        return None
+    areas = (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])
+    crop = face_align.norm_crop(img, kpss[int(areas.argmax())])
+    holder, done = {}, threading.Event()
+    _EMBED_Q.put((crop, holder, done))
+    done.wait()
+    if "error" in holder:
+        raise holder["error"]
+    return holder["embedding"]
+
 # 저장 폴더 생성
 os.makedirs(os.path.join(SAVE_DIR, "register"), exist_ok=True)
 os.makedirs(os.path.join(SAVE_DIR, "verify"), exist_ok=True)
 
+# ====================
+# 임베딩 SoA 저장소 (face_ids[i] <-> face_mat[i] 행 대응)
+# ====================
 try:
-    with open(DB_PATH, "r") as f: face_db = json.load(f)
-    print(f" DB Loaded: {len(face_db)} visitors")
+    with np.load(DB_PATH, allow_pickle=True) as db:
+        face_ids = [str(v) for v in db["ids"]]
+        face_mat = np.asarray(db["emb"], dtype=np.float32) if face_ids else None
+    print(f" DB Loaded: {len(face_ids)} visitors")
 except:
-    face_db = {}
-    print("⚠️ New DB Created")
+    try:
+        # 구버전 JSON DB 마이그레이션 (원본 임베딩은 정규화해서 적재)
+        with open(LEGACY_DB_PATH, "r") as f: legacy_db = json.load(f)
+        face_ids = list(legacy_db.keys())
+        face_mat = np.asarray([legacy_db[vid] for vid in face_ids], dtype=np.float32)
+        face_mat /= np.linalg.norm(face_mat, axis=1, keepdims=True)
+        print(f" Legacy JSON DB Migrated: {len(face_ids)} visitors")
+    except:
+        face_ids, face_mat = [], None
+        print("⚠️ New DB Created")
+
+def save_face_db():
+    """ids + 임베딩 행렬을 npz로 저장.
+
+    디스크에는 float16으로 내려 파일/IO를 절반으로 줄인다 (정규화된 벡터라
+    코사인 유사도 오차 <1e-3). 메모리 쪽은 FAISS/BLAS가 요구하는 float32 유지.
+    """
+    np.savez(DB_PATH, ids=np.array(face_ids), emb=face_mat.astype(np.float16))
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _cosine_sims(mat, q):
+        # LLVM이 FMA로 자동 벡터화 + 코어별 병렬화 (최초 1회 컴파일은 cache=True로 재사용)
+        n, d = mat.shape
+        out = np.empty(n, dtype=np.float32)
+        for i in prange(n):
+            s = 0.0
+            for j in range(d):
+                s += mat[i, j] * q[j]
+            out[i] = s
+        return out
+else:
+    _cosine_sims = None
+
+face_index = None
+
+def rebuild_face_index():
+    """face_mat 전체로 FAISS 인덱스 재구성 (방문객 수가 커지면 IndexHNSWFlat 고려)"""
+    global face_index
+    if faiss is None or face_mat is None:
+        face_index = None
+        return
+    face_index = faiss.IndexFlatIP(face_mat.shape[1])
+    face_index.add(face_mat)
+
+rebuild_face_index()
+
+def update_face_cache(vid, embedding):
+    """등록된 임베딩을 정규화해서 행렬 캐시에 반영"""
+    global face_mat
+    vec = np.asarray(embedding, dtype=np.float32)
+    vec = vec / norm(vec)
+    if vid in face_ids:  # 재등록이면 기존 행 갱신
+        face_mat[face_ids.index(vid)] = vec
+    elif face_mat is None:
+        face_ids.append(vid)
+        face_mat = vec[np.newaxis, :]
+    else:
+        face_ids.append(vid)
+        face_mat = np.vstack([face_mat, vec])
+    rebuild_face_index()
 
 # ====================
 # 이미지 처리 파이프라인
 # ====================
-def adjust_lut(image, gamma=1.0):
-    if gamma == 1.0: return image
-    inv_gamma = 1.0 / gamma
-    table = np.array([((i / 255.0) ** inv_gamma) * 255 for i in np.arange(0, 256)]).astype("uint8")
-    return cv2.LUT(image, table)
+def build_tone_lut():
+    """감마 + 대비 + 밝기를 합친 256 엔트리 LUT (설정 변경 시 재호출)"""
+    x = (np.arange(256, dtype=np.float32) / 255.0) ** (1.0 / IMG_CONFIG["GAMMA"])
+    x = x * 255.0 * IMG_CONFIG["CONTRAST"] + IMG_CONFIG["BRIGHTNESS"]
+    return np.clip(x, 0, 255).astype(np.uint8)
+
+# 보정 상수는 설정값이라 LUT를 임포트 시 한 번만 생성
+_TONE_LUT = build_tone_lut()
+
+@functools.lru_cache(maxsize=2)
+def _fmt_timestamp(sec):
+    """초 단위 타임스탬프 포맷 캐시 (같은 초에는 strftime을 다시 돌리지 않음)"""
+    return time.strftime("%Y%m%d_%H%M%S", time.localtime(sec))
+
+_SAVE_Q = queue.Queue(maxsize=64)
+
+def _save_worker():
+    while True:
+        img, path = _SAVE_Q.get()
+        try:
+            cv2.imwrite(path, img)
+        except Exception as e:
+            print(f"⚠️ Save failed: {e}")
+
+threading.Thread(target=_save_worker, daemon=True).start()
 
 def save_processed_image(img, mode, tag="unknown"):
-    """이미지 저장 (captured_images/mode/timestamp_tag.jpg)"""
+    """이미지 저장 큐 적재 (captured_images/mode/timestamp_tag.jpg)"""
     if not IMG_CONFIG["DEBUG_SAVE"]: return
-    
-    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+
+    timestamp = _fmt_timestamp(int(time.time()))
     filename = f"{timestamp}_{tag}.jpg"
     path = os.path.join(SAVE_DIR, mode, filename)
-    
-    cv2.imwrite(path, img)
-    # print(f" Saved: {path}") # 로그 너무 많으면 주석 처리
+
+    try:
+        _SAVE_Q.put_nowait((img.copy(), path))  # 호출자가 img를 계속 쓰므로 복사
+    except queue.Full:
+        pass  # 응답 지연보다 디버그 이미지 유실이 낫다
 
 def process_image(image_base64, width, height):
     """Base64 -> Image -> Resize/Crop -> Enhance"""
     # 1. Decode
-    img_bytes = base64.b64decode(image_base64)
+    img_bytes = _b64.b64decode(image_base64, validate=False)
     img_np = np.frombuffer(img_bytes, dtype=np.uint8)
-    
+
     if img_np.size != (width * height * 3):
-        eff_size = (img_np.size // 3) * 3
-        img_np = img_np[:eff_size]
-        h_eff = eff_size // (width * 3)
-        img = img_np.reshape((h_eff, width, 3))
-    else:
-        img = img_np.reshape((height, width, 3))
+        # 잘린 프레임을 조용히 reshape해서 쓰지 않고 바로 거부 (핸들러에서 400 응답)
+        raise ValueError(f"payload size mismatch: got {img_np.size} bytes, expected {width * height * 3}")
+    img = img_np.reshape((height, width, 3))
 
-    img = img[:, :, ::-1] # RGB to BGR
+    img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR) # 음수 stride 뷰 대신 연속 메모리 변환
 
     # 2. Flip
     if IMG_CONFIG["FLIP_VERTICAL"]:
         img = cv2.flip(img, 0)
 
-    # 3. Resize & Crop
+    # 3. Resize & Crop (크롭으로 버려질 영역은 보간하지 않음)
     h, w = img.shape[:2]
-    scale = IMG_CONFIG["TARGET_SIZE"] / min(h, w)
-    new_w, new_h = int(w * scale), int(h * scale)
-    img = cv2.resize(img, (new_w, new_h))
-
+    target = IMG_CONFIG["TARGET_SIZE"]
     if IMG_CONFIG["CROP_CENTER"]:
-        start_x = (new_w - IMG_CONFIG["TARGET_SIZE"]) // 2
-        start_y = (new_h - IMG_CONFIG["TARGET_SIZE"]) // 2
-        img = img[start_y:start_y+IMG_CONFIG["TARGET_SIZE"], start_x:start_x+IMG_CONFIG["TARGET_SIZE"]]
+        side = min(h, w)
+        start_y, start_x = (h - side) // 2, (w - side) // 2
+        img = cv2.resize(img[start_y:start_y+side, start_x:start_x+side],
+                         (target, target), interpolation=cv2.INTER_AREA)
+    else:
+        scale = target / min(h, w)
+        img = cv2.resize(img, (int(w * scale), int(h * scale)))
 
-    # 4. Enhance
-    img = adjust_lut(img, IMG_CONFIG["GAMMA"])
-    img = cv2.convertScaleAbs(img, alpha=IMG_CONFIG["CONTRAST"], beta=IMG_CONFIG["BRIGHTNESS"])
+    # 4. Enhance (감마/대비/밝기를 LUT 한 번으로 적용)
+    img = cv2.LUT(img, _TONE_LUT)
 
     return img
 
 def find_match(embedding):
-    best_id, best_sim = None, 0.0
-    for vid, data in face_db.items():
-        sim = np.dot(embedding, data) / (norm(embedding) * norm(data))
-        if sim > best_sim:
-            best_id, best_sim = vid, sim
-    return best_id, best_sim
+    if face_mat is None:
+        return None, 0.0
+    q = np.asarray(embedding, dtype=np.float32)
+    q = q / norm(q)
+    if face_index is not None:
+        D, I = face_index.search(q.reshape(1, -1), 1)
+        return face_ids[int(I[0, 0])], float(D[0, 0])
+    if _cosine_sims is not None:
+        sims = _cosine_sims(face_mat, q)
+    else:
+        sims = face_mat @ q  # 정규화된 행렬이라 한 번의 GEMV로 코사인 유사도 계산
+    best = int(sims.argmax())
+    return face_ids[best], float(sims[best])
 
 # ====================
 # API 엔드포인트
@@ -132,10 +330,9 @@ def find_match(embedding):
 @app.route("/register", methods=["POST"])
 def register():
     """ Visitor 등록 """
-    global face_db
     try:
         d = request.json
-        img = process_image(d["image"], d["width"], d["height"])
+        img = _PREP_POOL.submit(process_image, d["image"], d["width"], d["height"]).result()
         
         # UUID 추출
         vid = str(d.get("uuid", "unknown"))
@@ -145,19 +342,20 @@ def register():
         # 여기서는 인식 시도한 이미지를 무조건 저장
         save_processed_image(img, "register", tag=vid)
 
-        faces = face_app.get(img)
-        if not faces:
+        embedding = get_face_embedding(img)
+        if embedding is None:
             print("❌ Register: No face")
             return jsonify({"status": "failed", "error": "No face"}), 200
 
-        face = max(faces, key=lambda f: (f.bbox[2]-f.bbox[0]) * (f.bbox[3]-f.bbox[1]))
-        
-        face_db[vid] = face.embedding.tolist()
-        with open(DB_PATH, "w") as f: json.dump(face_db, f, indent=2)
+        update_face_cache(vid, embedding)
+        save_face_db()
         
         print(f"✅ Registered: {vid}")
         return jsonify({"status": "success", "visitor_id": vid}), 200
 
+    except ValueError as e:
+        print(f"❌ Bad Request: {e}")
+        return jsonify({"status": "failed", "error": str(e)}), 400
     except Exception as e:
         print(f"❌ Error: {e}")
         return jsonify({"status": "failed", "error": str(e)}), 500
@@ -167,16 +365,15 @@ def verify():
     """ Visitor 인증 """
     try:
         d = request.json
-        img = process_image(d.get("image"), d.get("width"), d.get("height"))
+        img = _PREP_POOL.submit(process_image, d.get("image"), d.get("width"), d.get("height")).result()
         
-        faces = face_app.get(img)
+        embedding = get_face_embedding(img)
 
-        if not faces:
+        if embedding is None:
             save_processed_image(img, "verify", tag="noface") # 얼굴 못 찾은 이미지 저장
             return jsonify({"is_registered": False, "error": "No face"}), 200
 
-        face = max(faces, key=lambda f: (f.bbox[2]-f.bbox[0]) * (f.bbox[3]-f.bbox[1]))
-        vid, sim = find_match(face.embedding)
+        vid, sim = find_match(embedding)
 
         # 결과에 따라 파일명 태그 설정
         tag = f"{vid}_ok" if (sim > SIMILARITY_THRESHOLD) else "unknown"
@@ -189,14 +386,17 @@ def verify():
             print(f"❌ Unknown ({sim:.2f})")
             return jsonify({"visitor_id": "", "is_registered": False, "similarity": float(sim)})
 
+    except ValueError as e:
+        print(f"❌ Bad Request: {e}")
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         print(f"❌ Verify Error: {e}")
         return jsonify({"error": str(e)}), 500
 
 @app.route("/status", methods=["GET"])
 def status():
-    return jsonify({"visitors": len(face_db), "threshold": SIMILARITY_THRESHOLD, "config": IMG_CONFIG})
+    return jsonify({"visitors": len(face_ids), "threshold": SIMILARITY_THRESHOLD, "config": IMG_CONFIG})
 
 if __name__ == "__main__":
-    print(f"\n Server Started on 5000 | Thresh: {SIMILARITY_THRESHOLD} | Visitors: {len(face_db)}")
+    print(f"\n Server Started on 5000 | Thresh: {SIMILARITY_THRESHOLD} | Visitors: {len(face_ids)}")
     app.run(host="0.0.0.0", port=5000, debug=False, threaded=True)
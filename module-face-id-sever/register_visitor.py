@@ -1,9 +1,10 @@
 import cv2
-import json
 import uuid
+import numpy as np
+from numpy.linalg import norm
 from insightface.app import FaceAnalysis
 
-DB_PATH = "face_db.json"
+DB_PATH = "face_db.npz"  # face_server.py와 같은 포맷 (ids + float16 임베딩 행렬)
 
 # ArcFace 모델 로드
 app = FaceAnalysis(name='buffalo_l', providers=['CUDAExecutionProvider'])
@@ -11,13 +12,18 @@ app.prepare(ctx_id=0)
 
 # 기존 DB 로드
 try:
-    with open(DB_PATH, "r") as f:
-        face_db = json.load(f)
-    print(f"📂 Loaded {len(face_db)} existing visitors")
+    with np.load(DB_PATH, allow_pickle=True) as db:
+        face_ids = [str(v) for v in db["ids"]]
+        face_mat = np.asarray(db["emb"], dtype=np.float32) if face_ids else None
+    print(f"📂 Loaded {len(face_ids)} existing visitors")
 except:
-    face_db = {}
+    face_ids, face_mat = [], None
     print("📂 Creating new database")
 
+def save_face_db():
+    """서버의 save_face_db와 동일 포맷: 디스크에는 float16으로 저장"""
+    np.savez(DB_PATH, ids=np.array(face_ids), emb=face_mat.astype(np.float16))
+
 cap = cv2.VideoCapture(0)
 print("\n" + "="*50)
 print("📸 Visitor Registration")
@@ -41,11 +47,12 @@ while True:
         faces = app.get(frame)
         if len(faces) > 0:
             visitor_id = f"visitor_{uuid.uuid4().hex[:8]}"
-            face_db[visitor_id] = faces[0].embedding.tolist()
-            
-            with open(DB_PATH, "w") as f:
-                json.dump(face_db, f, indent=2)
-            
+            emb = np.asarray(faces[0].embedding, dtype=np.float32)
+            emb = emb / norm(emb)
+            face_ids.append(visitor_id)
+            face_mat = emb[np.newaxis, :] if face_mat is None else np.vstack([face_mat, emb])
+            save_face_db()
+
             print(f"✅ Registered: {visitor_id}")
             
             cv2.putText(frame, f"Registered: {visitor_id}", (10, 70), 
@@ -67,7 +74,7 @@ cv2.destroyAllWindows()
 
 print("\n" + "="*50)
 print(f"🎉 Registration Complete")
-print(f"Total visitors: {len(face_db)}")
-for vid in face_db.keys():
+print(f"Total visitors: {len(face_ids)}")
+for vid in face_ids:
     print(f"  - {vid}")
 print("="*50 + "\n")
\ No newline at end of file
@@ -39,16 +39,16 @@ MIXAMO_JOINT_NAMES = [
 SMPL_PARENTS = [-1, 0, 0, 0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 9, 9, 12, 13, 14, 16, 17, 18, 19]
 
 def process_motion_data(data):
-    processed = data.copy()
-    if FIX_ROTATION != 0:
-        rad = math.radians(FIX_ROTATION)
-        cos_r = math.cos(rad)
-        sin_r = math.sin(rad)
-        x = processed[:, :, 0].copy()
-        z = processed[:, :, 2].copy()
-        processed[:, :, 0] = x * cos_r - z * sin_r
-        processed[:, :, 2] = x * sin_r + z * cos_r
-    return processed
+    if FIX_ROTATION == 0:
+        return data.copy()
+    rad = math.radians(FIX_ROTATION)
+    cos_r = math.cos(rad)
+    sin_r = math.sin(rad)
+    # Y축 회전을 3x3 행렬 matmul 한 번으로 적용 (X/Z 중간 복사 불필요)
+    rot = np.array([[cos_r, 0.0, -sin_r],
+                    [0.0,   1.0,  0.0],
+                    [sin_r, 0.0,  cos_r]], dtype=data.dtype)
+    return data @ rot.T
 
 def detect_active_frames(data, threshold=0.002):
     total_frames = data.shape[0]
@@ -63,13 +63,18 @@ def detect_active_frames(data, threshold=0.002):
 
 def apply_smoothing(data, window_size=5):
     if window_size <= 1: return data
-    frames, joints, coords = data.shape
-    smoothed_data = data.copy()
-    kernel = np.ones(window_size) / window_size
-    for j in range(joints):
-        for c in range(coords):
-            smoothed_data[:, j, c] = np.convolve(data[:, j, c], kernel, mode='same')
-    return smoothed_data
+    # 조인트/좌표별 np.convolve 66회 대신 프레임 축 누적합 한 번으로 이동평균
+    # (가장자리는 0 패딩 대신 첫/끝 프레임 복제라 시작/끝 포즈가 원점으로 쏠리지 않음)
+    pad_l = window_size // 2
+    pad_r = window_size - 1 - pad_l
+    padded = np.concatenate([
+        np.repeat(data[:1], pad_l, axis=0),
+        data,
+        np.repeat(data[-1:], pad_r, axis=0),
+    ], axis=0)
+    csum = np.cumsum(padded, axis=0, dtype=np.float64)
+    csum = np.concatenate([np.zeros((1,) + data.shape[1:]), csum], axis=0)
+    return ((csum[window_size:] - csum[:-window_size]) / window_size).astype(data.dtype)
 
 def append_loop_frames(data):
     start_pose = data[0]